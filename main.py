@@ -1,23 +1,168 @@
 # -*- coding: utf-8 -*-
 
+import atexit
+import json
+import logging
+import logging.handlers
 import os
+import posixpath
+from collections import defaultdict
+from cachetools import TTLCache
+from google.api_core.exceptions import (
+    DeadlineExceeded,
+    InternalServerError,
+    PreconditionFailed,
+    ServiceUnavailable,
+    TooManyRequests,
+)
 from google.cloud import documentai
 from google.cloud import storage
-import json
+import orjson
+import queue
+import signal
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 from flask import Flask, request
 
 app = Flask(__name__)
+log = logging.getLogger(__name__)
+
+class _JsonFormatter(logging.Formatter):
+    """Formatiert Log-Einträge als JSON-Zeile, deren Schweregrad Cloud Logging übernimmt."""
+
+    def format(self, record):
+        message = record.getMessage()
+        if record.exc_info:
+            message = f"{message}\n{self.formatException(record.exc_info)}"
+        return json.dumps(
+            {"severity": record.levelname, "message": message, "logger": record.name},
+            ensure_ascii=False,
+        )
+
+# Log-Einträge werden nur in eine Warteschlange gestellt. Ein Hintergrund-Thread schreibt
+# sie als JSON-Zeilen auf stdout, damit die Ausgabe nicht die Verarbeitung aufhält.
+_log_queue = queue.Queue()
+_stdout_handler = logging.StreamHandler()
+_stdout_handler.setFormatter(_JsonFormatter())
+_log_listener = logging.handlers.QueueListener(_log_queue, _stdout_handler)
+_log_listener.start()
+# Beim Beenden noch ausstehende Log-Einträge ausgeben
+atexit.register(_log_listener.stop)
+_queue_handler = logging.handlers.QueueHandler(_log_queue)
+# Nur die Nachricht (inkl. Traceback) übernehmen, das JSON-Format setzt der _JsonFormatter
+_queue_handler.setFormatter(logging.Formatter("%(message)s"))
+logging.basicConfig(level=logging.INFO, handlers=[_queue_handler])
 
 # Globaler Cache für verarbeitete Events (in Produktionsumgebung sollte Redis/Memcache verwendet werden)
-processed_events = {}
+# Einträge verfallen nach 10 Minuten, die Größe ist begrenzt, damit der Cache nicht unbegrenzt wächst.
+processed_events = TTLCache(maxsize=10_000, ttl=600)
+_processed_events_lock = threading.Lock()
+
+# --- Konfiguration aus Umgebungsvariablen laden ---
+# Diese Variablen müssen in der Cloud Run Konfiguration gesetzt werden.
+# Dies ist sicherer und flexibler als das Eintragen der Werte direkt in den Code.
+# Fehlt eine Variable, schlägt bereits der Start der Instanz fehl und nicht erst ein Request.
+try:
+    PROJECT_ID = os.environ["GCP_PROJECT"]
+    LOCATION = os.environ["PROCESSOR_LOCATION"]  # z.B. 'eu' oder 'us'
+    PROCESSOR_ID = os.environ["PROCESSOR_ID"]
+    OUTPUT_BUCKET = os.environ["OUTPUT_BUCKET"]
+except KeyError as e:
+    raise RuntimeError(f"Fehler: Die Umgebungsvariable {e} ist nicht gesetzt!") from e
+
+# Der Prozessor-Pfad ist für die Lebensdauer der Instanz konstant und wird nur einmal zusammengebaut.
+_PROCESSOR_PATH = f"projects/{PROJECT_ID}/locations/{LOCATION}/processors/{PROCESSOR_ID}"
+log.debug("📍 Prozessor-Pfad: %s", _PROCESSOR_PATH)
+
+# Clients werden einmal pro Instanz erzeugt und über alle Requests hinweg wiederverwendet,
+# damit Authentifizierung und Verbindungsaufbau nicht bei jedem Aufruf anfallen.
+_STORAGE = None
+_DOCAI = None
+
+def _get_storage_client():
+    global _STORAGE
+    if _STORAGE is None:
+        _STORAGE = storage.Client()
+    return _STORAGE
+
+def _get_docai_client():
+    global _DOCAI
+    if _DOCAI is None:
+        # WICHTIG: Den API-Endpunkt explizit basierend auf der Location setzen.
+        api_endpoint = f"{LOCATION}-documentai.googleapis.com"
+        log.debug("🔗 Verwende API-Endpunkt: %s", api_endpoint)
+        opts = {"api_endpoint": api_endpoint}
+        _DOCAI = documentai.DocumentProcessorServiceClient(client_options=opts)
+    return _DOCAI
+
+# Thread-Pool für die GCS-Operationen nach der Document AI Verarbeitung
+_IO_POOL = ThreadPoolExecutor(max_workers=4)
+
+# Clients möglichst schon beim Start der Instanz anlegen. Schlägt das fehl
+# (z.B. fehlende Credentials), werden sie beim ersten Request erzeugt.
+try:
+    _get_storage_client()
+    _get_docai_client()
+except Exception as e:
+    log.warning("⚠️ Clients konnten beim Start nicht initialisiert werden: %s", e)
+
+def _is_processable(event):
+    """
+    Prüft anhand der Event-Daten, ob die Datei verarbeitet werden soll.
+
+    Die Prüfungen kommen ohne Storage- oder Document AI-Aufrufe aus und laufen
+    deshalb bereits im HTTP-Handler, bevor das Event in die Warteschlange kommt.
+
+    Args:
+        event (dict): Das Event-Payload, das von Google Cloud bereitgestellt wird.
+
+    Returns:
+        bool: True, wenn die Datei verarbeitet werden soll.
+    """
+    # Nur JSON-Objekte sind gültige Storage-Events (z.B. keine Listen oder null)
+    if not isinstance(event, dict):
+        log.warning("⚠️ Ungültiges Event (%s). Verarbeitung wird übersprungen.", type(event).__name__)
+        return False
+
+    input_bucket_name = event.get("bucket", "")
+    file_name = event.get("name", "")
+    content_type = event.get("contentType", "")
+
+    log.info("✅ Datei erkannt: gs://%s/%s", input_bucket_name, file_name)
+    
+    # Prüfen, ob es sich um den Output-Bucket handelt - wenn ja, ignorieren
+    if input_bucket_name == OUTPUT_BUCKET:
+        log.warning("⚠️ Datei stammt aus dem Output-Bucket (%s). Verarbeitung wird übersprungen.", OUTPUT_BUCKET)
+        return False
+
+    # Prüfen, ob die Datei bereits verarbeitet wurde (hat .txt Endung oder enthält "_verarbeitet")
+    if file_name.endswith('.txt') or '_verarbeitet' in file_name:
+        log.warning("⚠️ Datei '%s' scheint bereits verarbeitet zu sein. Verarbeitung wird übersprungen.", file_name)
+        return False
+
+    # Sicherstellen, dass nur PDF-Dateien verarbeitet werden, um Fehler zu vermeiden.
+    if not content_type == "application/pdf":
+        log.warning("⚠️ Datei '%s' ist keine PDF-Datei (%s). Verarbeitung wird übersprungen.", file_name, content_type)
+        return False
+
+    return True
 
 @app.route("/", methods=["POST"])
 def http_entrypoint():
+    # Fährt die Instanz herunter, keine neuen Events mehr annehmen. Die Fehlerantwort
+    # sorgt dafür, dass Eventarc das Event erneut (an eine andere Instanz) zustellt.
+    if _shutting_down.is_set():
+        return ("", 503)
+
     # Cloud Functions (2nd gen) und Cloud Run schicken das Event als JSON im Body
     event = request.get_json(force=True)
-    
+
+    # Irrelevante Events (Output-Bucket, bereits verarbeitet, kein PDF) sofort verwerfen
+    if not _is_processable(event):
+        return ("", 204)
+
     # Event-ID für Deduplizierung extrahieren
     event_id = None
     if 'ce-eventid' in request.headers:
@@ -25,220 +170,275 @@ def http_entrypoint():
     elif 'eventId' in event:
         event_id = event['eventId']
     
-    # Kontext ist optional, kann leer bleiben
-    context = {}
-    process_document_from_gcs(event, context, event_id)
+    # Das Event wird nur in die Warteschlange gestellt und sofort bestätigt.
+    # Die eigentliche Verarbeitung übernimmt der Hintergrund-Worker.
+    _job_queue.put((event, event_id, 1))
     return ("", 204)
 
+# Warteschlange für eingehende Events. Mehrere Hintergrund-Threads holen die Events ab,
+# damit der HTTP-Worker nicht für die Dauer der Document AI Anfrage blockiert ist.
+# Zu den Auswirkungen auf den Betrieb siehe README ("Betrieb").
+_job_queue = queue.Queue()
+
+# Anzahl der Threads, die parallel Dokumente mit Document AI verarbeiten (Umgebungsvariable WORKER_COUNT)
+_WORKER_COUNT = int(os.environ.get("WORKER_COUNT", "4"))
+
+# Vorübergehende Fehler, bei denen ein Event erneut in die Warteschlange gestellt wird
+_TRANSIENT_ERRORS = (DeadlineExceeded, InternalServerError, ServiceUnavailable, TooManyRequests)
+_MAX_ATTEMPTS = 3
+_RETRY_DELAY = 5.0  # Sekunden, wächst mit jedem Versuch
+
+# Wird beim Herunterfahren gesetzt, danach werden keine neuen Events mehr angenommen
+_shutting_down = threading.Event()
+
+# Maximale Wartezeit (Sekunden) auf ausstehende Events beim Herunterfahren.
+# Cloud Run beendet die Instanz 10 Sekunden nach SIGTERM endgültig.
+_SHUTDOWN_TIMEOUT = 9.0
+
+def _requeue(item):
+    _job_queue.put(item)
+    # Das ursprüngliche Event erst nach dem erneuten Einreihen als erledigt markieren,
+    # damit _job_queue.join() auch auf ausstehende Wiederholungen wartet.
+    _job_queue.task_done()
+
+def _worker():
+    while True:
+        event, event_id, attempt = _job_queue.get()
+        try:
+            # Kontext ist optional, kann leer bleiben
+            process_document_from_gcs(event, {}, event_id)
+        except _TRANSIENT_ERRORS as e:
+            if attempt < _MAX_ATTEMPTS:
+                delay = _RETRY_DELAY * attempt
+                log.warning(
+                    "⚠️ Vorübergehender Fehler bei %s (Versuch %s/%s), neuer Versuch in %s s: %s",
+                    event.get('name'), attempt, _MAX_ATTEMPTS, delay, e,
+                )
+                timer = threading.Timer(delay, _requeue, args=((event, event_id, attempt + 1),))
+                timer.daemon = True
+                timer.start()
+                continue
+            log.error("❌ Verarbeitung von %s nach %s Versuch(en) aufgegeben: %s", event.get('name'), attempt, e)
+        except Exception:
+            # Ein fehlerhaftes Event darf den Worker nicht beenden
+            log.exception("❌ Unerwarteter Fehler bei der Verarbeitung von %s", event.get('name'))
+        _job_queue.task_done()
+
+for _i in range(_WORKER_COUNT):
+    threading.Thread(target=_worker, name=f"docai-worker-{_i}", daemon=True).start()
+
+def _drain():
+    """
+    Wartet beim Herunterfahren, bis alle angenommenen Events verarbeitet und die
+    Ergebnisse gespeichert sind (höchstens _SHUTDOWN_TIMEOUT Sekunden).
+    """
+    _shutting_down.set()
+    log.info("🛑 Instanz wird beendet, warte auf %s ausstehende Event(s).", _job_queue.unfinished_tasks)
+    joiner = threading.Thread(target=_job_queue.join, daemon=True)
+    joiner.start()
+    joiner.join(_SHUTDOWN_TIMEOUT)
+    if joiner.is_alive():
+        log.error("❌ %s Event(s) konnten vor dem Beenden nicht verarbeitet werden.", _job_queue.unfinished_tasks)
+    _IO_POOL.shutdown(wait=True)
+
+def _handle_sigterm(signum, frame):
+    _drain()
+    # Anschließend das ursprüngliche Verhalten ausführen (z.B. den Gunicorn-Worker beenden)
+    if callable(_previous_sigterm_handler):
+        _previous_sigterm_handler(signum, frame)
+    else:
+        raise SystemExit(0)
+
+# Signal-Handler können nur im Haupt-Thread registriert werden
+try:
+    _previous_sigterm_handler = signal.signal(signal.SIGTERM, _handle_sigterm)
+except ValueError:
+    log.warning("⚠️ SIGTERM-Handler konnte nicht registriert werden, ausstehende Events gehen beim Beenden verloren.")
+
 def process_document_from_gcs(event, context, event_id=None):
     """
     Diese Cloud Function wird durch einen Datei-Upload in einen Google Cloud Storage
     Bucket ausgelöst. Sie analysiert das Dokument mit Document AI und speichert
     den extrahierten Text in einem anderen Bucket.
+    Das Event muss vorher mit _is_processable geprüft worden sein.
 
     Args:
         event (dict): Das Event-Payload, das von Google Cloud bereitgestellt wird.
                       Es enthält Details zur hochgeladenen Datei.
         context (google.cloud.functions.Context): Metadaten zum Event.
     """
-    # --- 1. Konfiguration aus Umgebungsvariablen laden ---
-    # Diese Variablen müssen in der Google Cloud Function Konfiguration gesetzt werden.
-    # Dies ist sicherer und flexibler als das Eintragen der Werte direkt in den Code.
-    try:
-        project_id = os.environ["GCP_PROJECT"]
-        location = os.environ["PROCESSOR_LOCATION"]  # z.B. 'eu' oder 'us'
-        processor_id = os.environ["PROCESSOR_ID"]
-        output_bucket_name = os.environ["OUTPUT_BUCKET"]
-    except KeyError as e:
-        print(f"Fehler: Die Umgebungsvariable {e} ist nicht gesetzt!")
-        # Beendet die Funktion, da die Konfiguration unvollständig ist.
-        return
-
-    # --- 2. Informationen zur Trigger-Datei aus dem Event auslesen ---
+    # --- 1. Informationen zur Trigger-Datei aus dem Event auslesen ---
     input_bucket_name = event["bucket"]
     file_name = event["name"]
     content_type = event.get("contentType", "")
 
-    print(f"✅ Datei erkannt: gs://{input_bucket_name}/{file_name}")
-    
-    # Prüfen, ob es sich um den Output-Bucket handelt - wenn ja, ignorieren
-    if input_bucket_name == output_bucket_name:
-        print(f"⚠️ Datei stammt aus dem Output-Bucket ({output_bucket_name}). Verarbeitung wird übersprungen.")
-        return
-
-    # Prüfen, ob die Datei bereits verarbeitet wurde (hat .txt Endung oder enthält "_verarbeitet")
-    if file_name.endswith('.txt') or '_verarbeitet' in file_name:
-        print(f"⚠️ Datei '{file_name}' scheint bereits verarbeitet zu sein. Verarbeitung wird übersprungen.")
-        return
-
-    # Sicherstellen, dass nur PDF-Dateien verarbeitet werden, um Fehler zu vermeiden.
-    if not content_type == "application/pdf":
-        print(f"⚠️ Datei '{file_name}' ist keine PDF-Datei ({content_type}). Verarbeitung wird übersprungen.")
-        return
-
-    # --- 3. Document AI und Storage Clients initialisieren ---
-    storage_client = storage.Client()
-    
-    # **WICHTIG: Zuerst prüfen, ob die Ausgabedatei bereits existiert**
-    # Das ist die dauerhafte Prüfung, die unabhängig vom Event-Cache funktioniert
-    output_filename = f"{os.path.splitext(file_name)[0]}.txt"
-    output_bucket = storage_client.bucket(output_bucket_name)
-    output_blob = output_bucket.blob(output_filename)
-    
-    if output_blob.exists():
-        print(f"⚠️ Ausgabedatei '{output_filename}' existiert bereits. Verarbeitung wird übersprungen.")
-        return
+    # GCS-Objektnamen sind immer POSIX-Pfade, daher posixpath statt os.path
+    # (os.path würde unter Windows auch Backslashes als Trenner behandeln).
+    stem = posixpath.splitext(file_name)[0]
 
     # Event-Deduplizierung - verhindert mehrfache Verarbeitung desselben Events (nur für kurze Zeit)
+    # Die dauerhafte Prüfung über Instanzen hinweg erfolgt beim Hochladen der
+    # Ausgabedatei (if_generation_match=0, siehe Schritt 5).
     if event_id:
         cache_key = f"{event_id}_{input_bucket_name}_{file_name}"
-        current_time = time.time()
-        
-        # Prüfen, ob dieses Event bereits verarbeitet wurde (Cache für 10 Minuten)
-        if cache_key in processed_events:
-            if current_time - processed_events[cache_key] < 600:  # 10 Minuten
-                print(f"⚠️ Event {event_id} bereits verarbeitet. Überspringe.")
-                return
-        
-        # Event als verarbeitet markieren
-        processed_events[cache_key] = current_time
-        
-        # Alte Einträge aus dem Cache entfernen (älter als 10 Minuten)
-        to_remove = [k for k, v in processed_events.items() if current_time - v > 600]
-        for k in to_remove:
-            del processed_events[k]
-        
-        print(f"🔄 Verarbeite Event {event_id}")
-
-    # Prüfen, ob es sich um den Output-Bucket handelt - wenn ja, ignorieren
-    if input_bucket_name == output_bucket_name:
-        print(f"⚠️ Datei stammt aus dem Output-Bucket ({output_bucket_name}). Verarbeitung wird übersprungen.")
-        return
 
-    # Prüfen, ob die Datei bereits verarbeitet wurde (hat .txt Endung oder enthält "_verarbeitet")
-    if file_name.endswith('.txt') or '_verarbeitet' in file_name:
-        print(f"⚠️ Datei '{file_name}' scheint bereits verarbeitet zu sein. Verarbeitung wird übersprungen.")
-        return
+        with _processed_events_lock:
+            # Prüfen, ob dieses Event bereits verarbeitet wurde (Cache für 10 Minuten)
+            if cache_key in processed_events:
+                log.warning("⚠️ Event %s bereits verarbeitet. Überspringe.", event_id)
+                return
 
-    # Sicherstellen, dass nur PDF-Dateien verarbeitet werden, um Fehler zu vermeiden.
-    if not content_type == "application/pdf":
-        print(f"⚠️ Datei '{file_name}' ist keine PDF-Datei ({content_type}). Verarbeitung wird übersprungen.")
-        return
+            # Event als verarbeitet markieren
+            processed_events[cache_key] = time.time()
 
-    # --- 3. Document AI und Storage Clients initialisieren ---
-    # Es wird empfohlen, Clients innerhalb der Funktion zu initialisieren.
-    storage_client = storage.Client()
-    # WICHTIG: Den API-Endpunkt explizit basierend auf der Location setzen.
-    # Für EU-Region muss der Endpunkt korrekt sein
-    if location == "eu":
-        api_endpoint = "eu-documentai.googleapis.com"
-    elif location == "us":
-        api_endpoint = "us-documentai.googleapis.com"
-    else:
-        api_endpoint = f"{location}-documentai.googleapis.com"
-    
-    print(f"🔗 Verwende API-Endpunkt: {api_endpoint}")
-    opts = {"api_endpoint": api_endpoint}
-    docai_client = documentai.DocumentProcessorServiceClient(client_options=opts)
+        log.info("🔄 Verarbeite Event %s", event_id)
 
-    # Den vollständigen Pfad zum Document AI Prozessor zusammenbauen.
-    processor_path = docai_client.processor_path(project_id, location, processor_id)
-    print(f"📍 Prozessor-Pfad: {processor_path}")
+    # --- 2. Document AI und Storage Clients holen ---
+    # Die Clients werden pro Instanz wiederverwendet (siehe _get_storage_client/_get_docai_client).
+    storage_client = _get_storage_client()
+    docai_client = _get_docai_client()
 
-    # --- 4. Dokument aus dem Storage laden und verarbeiten ---
-    print(f"⚙️ Verarbeite Dokument mit Prozessor: {processor_id}")
+    # --- 3. Dokument direkt aus dem Storage verarbeiten ---
+    log.info("⚙️ Verarbeite Dokument mit Prozessor: %s", PROCESSOR_ID)
     try:
-        # Die Datei aus dem Input-Bucket als Bytes herunterladen.
-        input_bucket = storage_client.bucket(input_bucket_name)
-        input_blob = input_bucket.blob(file_name)
-        image_content = input_blob.download_as_bytes()
-
-        # Das Dokument für die API-Anfrage vorbereiten.
-        raw_document = documentai.RawDocument(
-            content=image_content,
+        # Document AI liest die Datei selbst aus dem Input-Bucket. Dadurch muss
+        # das PDF nicht erst in den Speicher des Containers geladen werden.
+        gcs_document = documentai.GcsDocument(
+            gcs_uri=f"gs://{input_bucket_name}/{file_name}",
             mime_type=content_type,
         )
 
         # Die Anfrage an die Document AI API senden.
         request = documentai.ProcessRequest(
-            name=processor_path,
-            raw_document=raw_document
+            name=_PROCESSOR_PATH,
+            gcs_document=gcs_document
         )
         result = docai_client.process_document(request=request)
         document = result.document
-        print("📄 Dokument erfolgreich verarbeitet.")
+        log.info("📄 Dokument erfolgreich verarbeitet.")
 
+    except _TRANSIENT_ERRORS:
+        # Event wieder freigeben, damit der erneute Versuch nicht als Duplikat verworfen wird
+        if event_id:
+            with _processed_events_lock:
+                processed_events.pop(cache_key, None)
+        raise
     except Exception as e:
-        print(f"❌ Fehler bei der Document AI Verarbeitung: {e}")
+        log.error("❌ Fehler bei der Document AI Verarbeitung: %s", e)
         return
 
-    # --- 5. Ergebnis in den Output-Bucket speichern ---
-    # Strukturierte Daten aus dem trainierten Modell extrahieren
-    extracted_data = {
-        "document_info": {
-            "filename": file_name,
-            "processing_time": time.strftime("%Y-%m-%d %H:%M:%S"),
-            "processor_id": processor_id,
-            "total_pages": len(document.pages) if document.pages else 0
-        },
-        "entities": {},
-        "raw_text": document.text
-    }
-
+    # --- 4. Ergebnis aufbereiten ---
     # Entitäten aus dem trainierten Modell extrahieren
+    entities = defaultdict(list)
     if document.entities:
-        print(f"🔍 {len(document.entities)} Entitäten gefunden:")
+        # Details pro Entität nur im Debug-Level ausgeben, bei vielen Entitäten
+        # bremst die Ausgabe jeder einzelnen Zeile sonst die Verarbeitung aus.
+        debug = log.isEnabledFor(logging.DEBUG)
         for entity in document.entities:
             entity_type = entity.type_
             entity_value = entity.mention_text
             confidence = entity.confidence
-            
-            print(f"  - {entity_type}: {entity_value} (Konfidenz: {confidence:.2f})")
-            
+            normalized_value = entity.normalized_value
+
+            if debug:
+                log.debug("  - %s: %s (Konfidenz: %.2f)", entity_type, entity_value, confidence)
+
             # Entität zu den extrahierten Daten hinzufügen
-            if entity_type not in extracted_data["entities"]:
-                extracted_data["entities"][entity_type] = []
-            
-            extracted_data["entities"][entity_type].append({
+            entities[entity_type].append({
                 "value": entity_value,
                 "confidence": confidence,
-                "normalized_value": entity.normalized_value.text if entity.normalized_value else None
+                "normalized_value": normalized_value.text if normalized_value else None
             })
+
+        log.info("🔍 %s Entitäten in %s Typen gefunden.", len(document.entities), len(entities))
     else:
-        print("⚠️ Keine Entitäten gefunden. Möglicherweise ist das Modell noch nicht trainiert.")
+        log.warning("⚠️ Keine Entitäten gefunden. Möglicherweise ist das Modell noch nicht trainiert.")
 
-    # Zusätzliche Dokumenteigenschaften extrahieren
-    if document.pages:
-        extracted_data["document_info"]["dimensions"] = {
-            "width": document.pages[0].dimension.width,
-            "height": document.pages[0].dimension.height,
-            "unit": document.pages[0].dimension.unit
-        }
+    # Zusätzliche Dokumenteigenschaften (Abmessungen der ersten Seite) extrahieren
+    pages = document.pages
+    dimension = pages[0].dimension if pages else None
+
+    # Strukturierte Daten in einem Schritt zusammenstellen
+    extracted_data = {
+        "document_info": {
+            "filename": file_name,
+            "processing_time": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "processor_id": PROCESSOR_ID,
+            "total_pages": len(pages),
+            **({"dimensions": {
+                "width": dimension.width,
+                "height": dimension.height,
+                "unit": dimension.unit
+            }} if dimension is not None else {})
+        },
+        "entities": dict(entities),
+        "raw_text": document.text
+    }
 
     # Den Dateinamen für die Ausgabedatei festlegen (z.B. original.pdf -> original.json)
-    output_filename = f"{os.path.splitext(file_name)[0]}.json"
-    
-    try:
-        output_bucket = storage_client.bucket(output_bucket_name)
-        output_blob = output_bucket.blob(output_filename)
-        
-        # Die strukturierten Daten als JSON hochladen
-        json_content = json.dumps(extracted_data, ensure_ascii=False, indent=2)
-        output_blob.upload_from_string(json_content, content_type="application/json; charset=utf-8")
-        
-        print(f"🎉 Strukturierte Daten erfolgreich in gs://{output_bucket_name}/{output_filename} gespeichert.")
-        print(f"📊 Extrahierte Entitätstypen: {list(extracted_data['entities'].keys())}")
-
-        # --- 6. Eingangsdatei löschen nach erfolgreicher Verarbeitung ---
-        try:
-            input_bucket = storage_client.bucket(input_bucket_name)
-            input_blob = input_bucket.blob(file_name)
-            input_blob.delete()
-            print(f"🗑️ Eingangsdatei gs://{input_bucket_name}/{file_name} erfolgreich gelöscht.")
-        except Exception as delete_error:
-            print(f"⚠️ Warnung: Eingangsdatei konnte nicht gelöscht werden: {delete_error}")
-            # Fehler beim Löschen ist nicht kritisch, da das Dokument bereits verarbeitet wurde
+    output_filename = f"{stem}.json"
+    output_blob = storage_client.bucket(OUTPUT_BUCKET).blob(output_filename)
+    input_blob = storage_client.bucket(input_bucket_name).blob(file_name)
+
+    # orjson erzeugt direkt UTF-8 Bytes, ohne Umweg über einen Python-String.
+    json_content = orjson.dumps(extracted_data, option=orjson.OPT_INDENT_2)
 
+    # Speichern und Löschen laufen im I/O-Thread-Pool, damit der Worker bereits
+    # das nächste Dokument an Document AI schicken kann.
+    future = _IO_POOL.submit(
+        _store_result, output_blob, json_content, input_blob, extracted_data["entities"]
+    )
+    future.add_done_callback(_log_store_error)
+
+def _log_store_error(future):
+    # Unerwartete Fehler aus dem I/O-Thread-Pool würden sonst unbemerkt im Future verschwinden
+    error = future.exception()
+    if error is not None:
+        log.error("❌ Unerwarteter Fehler beim Speichern des Ergebnisses", exc_info=error)
+
+def _store_result(output_blob, json_content, input_blob, entities):
+    """
+    Speichert das Ergebnis im Output-Bucket und löscht anschließend die Eingangsdatei.
+
+    Args:
+        output_blob (google.cloud.storage.Blob): Ziel für die JSON-Ergebnisdatei.
+        json_content (bytes): Die serialisierten Ergebnisdaten.
+        input_blob (google.cloud.storage.Blob): Die verarbeitete Eingangsdatei.
+        entities (dict): Die extrahierten Entitäten nach Typ (nur für die Ausgabe).
+    """
+    # --- 5. Ergebnis in den Output-Bucket speichern ---
+    try:
+        # Die strukturierten Daten als JSON hochladen. if_generation_match=0 sorgt dafür,
+        # dass nur hochgeladen wird, wenn die Ausgabedatei noch nicht existiert.
+        output_blob.upload_from_string(
+            json_content,
+            content_type="application/json; charset=utf-8",
+            if_generation_match=0,
+        )
+    except PreconditionFailed:
+        # Die Ausgabedatei existiert bereits (z.B. erneuter Upload eines überarbeiteten
+        # Datenblatts unter demselben Namen). Das vorhandene Ergebnis wird nicht
+        # überschrieben und die Eingangsdatei NICHT gelöscht, damit keine Daten verloren
+        # gehen. Die verbleibende Eingangsdatei zeigt an, dass sie manuell geprüft werden muss.
+        log.error(
+            "❌ Ausgabedatei gs://%s/%s existiert bereits. Eingangsdatei gs://%s/%s wird "
+            "nicht gelöscht und muss manuell geprüft werden.",
+            output_blob.bucket.name, output_blob.name, input_blob.bucket.name, input_blob.name,
+        )
+        return
     except Exception as e:
-        print(f"❌ Fehler beim Speichern der Ergebnisdatei: {e}")
-        # Eingangsdatei NICHT löschen, wenn die Verarbeitung fehlgeschlagen ist
\ No newline at end of file
+        log.error("❌ Fehler beim Speichern der Ergebnisdatei: %s", e)
+        # Eingangsdatei NICHT löschen, wenn die Verarbeitung fehlgeschlagen ist
+        return
+
+    log.info("🎉 Strukturierte Daten erfolgreich in gs://%s/%s gespeichert.", output_blob.bucket.name, output_blob.name)
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug("📊 Extrahierte Entitätstypen: %s", list(entities))
+
+    # --- 6. Eingangsdatei löschen nach erfolgreicher Verarbeitung ---
+    try:
+        input_blob.delete()
+        log.info("🗑️ Eingangsdatei gs://%s/%s erfolgreich gelöscht.", input_blob.bucket.name, input_blob.name)
+    except Exception as delete_error:
+        log.warning("⚠️ Warnung: Eingangsdatei konnte nicht gelöscht werden: %s", delete_error)
+        # Fehler beim Löschen ist nicht kritisch, da das Dokument bereits verarbeitet wurde